@@ -1,29 +1,52 @@
 import streamlit as st
-import pypandoc
 import os
 import tempfile
 import zipfile
-import re
 import base64
+import hashlib
 import requests
-from io import BytesIO
 
 # --- 頁面配置 ---
-from core.converter import process_mermaid_to_local_img, convert_md_to_docx
+from core.converter import process_mermaid_to_local_img, convert_md_to_docx, convert_md_file_to_docx, batch_convert, warm_up_pandoc, prune_mermaid_cache, prune_template_cache, has_mermaid_blocks, ensure_private_dir, write_cache_file, TEMPLATE_CACHE_DIR
 from core.style_analyzer import get_docx_style_info
 
+# 檔名中不允許的字元對照表（以 str.translate 單次替換為底線）
+_NAME_TRANS = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+
+# 每次轉換的工作目錄：Linux 上 /dev/shm (tmpfs) 空間足夠時優先使用，中繼 .md、輸出 .docx 與 ZIP 不落實體磁碟；
+# 空間過小（例如 Docker 預設僅 64 MB）時退回系統暫存目錄，避免批次輸出寫滿而失敗
+SHM_MIN_FREE_BYTES = 512 * 1024 * 1024
+
+def _work_dir_root():
+    try:
+        if not os.access("/dev/shm", os.W_OK):
+            return None
+        stat = os.statvfs("/dev/shm")
+    except (OSError, AttributeError):
+        return None
+    return "/dev/shm" if stat.f_bavail * stat.f_frsize >= SHM_MIN_FREE_BYTES else None
+
+WORK_DIR_ROOT = _work_dir_root()
+
 # --- 頁面配置 ---
 st.set_page_config(page_title="專業級 MD 轉 Word 工具", page_icon="📈", layout="wide")
 
 # --- Streamlit UI 介面 ---
 # --- Streamlit UI 介面 ---
+@st.cache_data(show_spinner=False)
 def load_css():
     css_path = os.path.join("assets", "custom.css")
     if os.path.exists(css_path):
         with open(css_path, "r", encoding="utf-8") as f:
-            st.markdown(f'<style>{f.read()}</style>', unsafe_allow_html=True)
+            return f.read()
+    return ""
 
-load_css()
+css = load_css()
+if css:
+    st.markdown(f'<style>{css}</style>', unsafe_allow_html=True)
+warm_up_pandoc()
+prune_mermaid_cache()
+prune_template_cache()
 
 # Header Section
 st.markdown("""
@@ -55,6 +78,13 @@ with st.sidebar:
         meta_author = st.text_input("作者", placeholder="您的姓名")
         meta_date = st.text_input("日期", placeholder="YYYY-MM-DD")
 
+# Helper: 內建範本清單快取 60 秒，避免每次互動都重新列目錄
+@st.cache_data(ttl=60, show_spinner=False)
+def list_templates(templates_dir):
+    if not os.path.exists(templates_dir):
+        os.makedirs(templates_dir)
+    return [f for f in os.listdir(templates_dir) if f.endswith(".docx")]
+
 # --- Template Selection & Style Preview (Main Area) ---
 st.markdown("### 🎨 選擇與預覽範本")
 col_tmpl_1, col_tmpl_2 = st.columns([1, 2])
@@ -68,9 +98,7 @@ default_template_path = None
 with col_tmpl_2:
     if template_source == "使用內建範本":
         templates_dir = "templates"
-        if not os.path.exists(templates_dir):
-            os.makedirs(templates_dir)
-        template_files = [f for f in os.listdir(templates_dir) if f.endswith(".docx")]
+        template_files = list_templates(templates_dir)
         
         if template_files:
             selected_template = st.selectbox("選擇範本樣式", template_files, label_visibility="collapsed")
@@ -81,31 +109,164 @@ with col_tmpl_2:
         ref_file = st.file_uploader("上傳 .docx 範本", type=["docx"], label_visibility="collapsed")
 
 # --- Logic for Style Preview ---
+# 樣式表以範本路徑（內建）或內容雜湊（自訂）為鍵快取，避免每次重跑都重新解析 docx
+@st.cache_data(show_spinner=False, max_entries=32)
+def load_style_info(source_key, _source):
+    return get_docx_style_info(_source)
+
 target_style_source = default_template_path if template_source == "使用內建範本" else ref_file
 if target_style_source:
     with st.expander(f"👁️ 查看樣式詳情 ({'內建' if default_template_path else '自訂'})"):
-        df_styles = get_docx_style_info(target_style_source)
-        st.dataframe(df_styles, hide_index=True, use_container_width=True)
+        if default_template_path:
+            # 加入修改時間，內建範本被就地更新時快取自動失效
+            style_key = f"{default_template_path}:{os.path.getmtime(default_template_path)}"
+        else:
+            style_key = hashlib.blake2b(ref_file.getbuffer()).hexdigest()
+        style_rows = load_style_info(style_key, target_style_source)
+        st.dataframe(style_rows, hide_index=True, use_container_width=True)
 
 # --- Main Content: Tabs ---
 st.markdown("<div style='margin-bottom: 2rem;'></div>", unsafe_allow_html=True)
 tab_upload, tab_paste = st.tabs(["📁 批量上傳轉換", "✍️ 線上編輯貼上"])
 
+# Helper: 將自訂範本落地為持久檔案，以內容雜湊為鍵跨次點擊重用
+# 不使用 cache_resource：每次都確認檔案仍存在，被暫存清理程式刪除時會重新寫入
+# 存放於使用者私有的快取目錄；無法使用時退回本次轉換的暫存目錄
+def materialize_template(digest, data, tmpdir):
+    try:
+        template_dir = ensure_private_dir(TEMPLATE_CACHE_DIR)
+    except OSError:
+        template_dir = tmpdir
+    template_path = os.path.join(template_dir, f"{digest}.docx")
+    if os.path.exists(template_path):
+        # 更新修改時間，讓 LRU 淘汰以最近使用為準
+        os.utime(template_path)
+    else:
+        # 先寫入暫存檔再 os.replace：中斷時不會留下殘缺範本，其他工作階段也不會讀到寫一半的檔案
+        write_cache_file(template_path, (data,))
+    return template_path
+
 # Helper for Options
+# 每次轉換（含批次 ZIP）只呼叫一次：ref_path 為固定路徑，批次中每個檔案共用同一份範本，不逐檔重寫
 def get_conversion_options(tmpdir):
     ref_path = None
     if default_template_path:
         ref_path = default_template_path
     elif ref_file:
-        ref_path = os.path.join(tmpdir, "user_style.docx")
-        with open(ref_path, "wb") as f:
-            f.write(ref_file.getbuffer())
+        data = ref_file.getbuffer()
+        ref_path = materialize_template(hashlib.blake2b(data).hexdigest(), data, tmpdir)
     
     return {
         "add_toc": add_toc, "math_support": math_support, "ref_path": ref_path,
+        # 範本修改時間納入選項：內建範本被就地更新時，convert_md_to_docx_cached 的快取自動失效
+        "ref_mtime": os.path.getmtime(ref_path) if ref_path else None,
         "meta_title": meta_title, "meta_author": meta_author, "meta_date": meta_date
     }
 
+# Helper: 相同內容與選項重複轉換時直接取回快取的 docx，不再呼叫 Pandoc
+# 僅快取 Pandoc 步驟；傳入內容須已處理過 Mermaid
+@st.cache_data(show_spinner=False, max_entries=32)
+def _pandoc_to_docx_cached(md_content, output_name, options):
+    return convert_md_to_docx(md_content, output_name, options, None, skip_mermaid=True)
+
+# Helper: Mermaid 在快取外處理，下載失敗（保留原始碼區塊）的結果不會被快取；
+# 圖片路徑以原始碼雜湊命名，處理後的文字相同即可命中 Pandoc 快取
+def convert_md_to_docx_cached(md_content, output_name, options, tmpdir):
+    if has_mermaid_blocks(md_content):
+        if not isinstance(md_content, str):
+            md_content = str(md_content, "utf-8")
+        md_content = process_mermaid_to_local_img(md_content, tmpdir)
+    return _pandoc_to_docx_cached(md_content, output_name, options)
+
+# Helper: 以 fragment 包裝轉換流程，點擊轉換/下載時只重跑此區塊，不重跑範本與預覽
+@st.fragment
+def run_upload_conversion(files_to_process):
+    if st.button("🚀 開始轉換專案", type="primary", use_container_width=True):
+        if not files_to_process:
+            st.error("請至少選擇一個檔案")
+        else:
+            with st.spinner('正在處理文檔與圖表...'):
+                try:
+                    with tempfile.TemporaryDirectory(dir=WORK_DIR_ROOT) as tmpdir:
+                        options = get_conversion_options(tmpdir)
+                        
+                        # Single File or No Merge -> Zip or individual download?
+                        # Logic: If single file, direct download. If multiple and NOT merge, Zip. If merge, direct download.
+                        
+                        # Case 1: Single Output (One file uploaded OR Merge all)
+                        if len(files_to_process) == 1 or merge_output:
+                            if merge_output and len(files_to_process) > 1:
+                                # Merge Logic：逐檔寫入磁碟上的合併檔，由 pandoc 直接讀檔，不在記憶體中組出完整字串
+                                mermaid_cache = {}
+                                page_break = b'\n\n```{=openxml}\n<w:p><w:r><w:br w:type="page"/></w:r></w:p>\n```\n\n'
+                                merged_path = os.path.join(tmpdir, "merged.md")
+                                with open(merged_path, "wb") as merged:
+                                    if add_toc: merged.write(page_break) # hack for TOC position if needed or handled by pandoc
+                                    for idx, file in enumerate(files_to_process):
+                                        if idx:
+                                            merged.write(page_break)
+                                        # 不含 Mermaid 的檔案直接寫入上傳緩衝區，不經 UTF-8 解碼/編碼
+                                        buf = file.getbuffer()
+                                        if not has_mermaid_blocks(buf):
+                                            merged.write(buf)
+                                            continue
+                                        raw = str(buf, "utf-8")
+                                        merged.write(process_mermaid_to_local_img(raw, tmpdir, mermaid_cache).encode("utf-8"))
+                                
+                                output_name = "Merged_Document"
+                                docx_bytes = convert_md_file_to_docx(merged_path, options)
+                            else:
+                                # Single File
+                                f = files_to_process[0]
+                                output_name = os.path.splitext(f.name)[0]
+                                docx_bytes = convert_md_to_docx_cached(f.getvalue(), output_name, options, tmpdir)
+
+                            st.success("🎉 轉換完成！")
+                            st.download_button(
+                                label=f"📥 下載 {output_name}.docx",
+                                data=docx_bytes,
+                                file_name=f"{output_name}.docx",
+                                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                                type="primary",
+                                use_container_width=True
+                            )
+                        
+                        # Case 2: Multiple Files, No Merge -> ZIP
+                        else:
+                            # docx 本身已是壓縮過的 ZIP，再 DEFLATE 幾乎無效，直接以 STORED 寫入暫存檔
+                            zip_path = os.path.join(tmpdir, "converted_docs.zip")
+                            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as zf:
+                                # 一次交給 batch_convert，由少數幾個並行子行程分組完成所有檔案轉換
+                                progress_text = st.empty()
+                                bar = st.progress(0)
+                                
+                                # 直接傳入檔案物件，由 batch_convert 逐檔分塊原樣寫入磁碟，不經 UTF-8 解碼
+                                batch_inputs = [(os.path.splitext(file.name)[0], file) for file in files_to_process]
+                                
+                                converted = batch_convert(
+                                    batch_inputs, options, tmpdir,
+                                    progress_callback=lambda done, total: bar.progress(done / total)
+                                )
+                                # ZipFile.write 由磁碟分塊串流寫入，不將整份 docx 讀入記憶體
+                                for fname, docx_path in converted:
+                                    zf.write(docx_path, arcname=f"{fname}.docx")
+                                
+                                progress_text.text("打包完成！")
+                            
+                            st.success("🎉 批量轉換完成！")
+                            with open(zip_path, "rb") as zip_file:
+                                st.download_button(
+                                    label="📥 下載轉換結果 (ZIP)",
+                                    data=zip_file,
+                                    file_name="converted_docs.zip",
+                                    mime="application/zip",
+                                    type="primary",
+                                    use_container_width=True
+                                )
+
+                except Exception as e:
+                    st.error(f"發生錯誤: {e}")
+
 # --- TAB 1: Upload ---
 with tab_upload:
     st.markdown("#### 上傳 Markdown 檔案")
@@ -126,11 +287,16 @@ with tab_upload:
         # Sort Logic if Merging
         if merge_output and len(uploaded_files) > 1:
             st.markdown("##### 🔀 調整合併順序")
-            file_map = {f.name: f for f in uploaded_files}
+            # 單次走訪同時建立檔名清單與對照表，options 與 default 共用同一份清單
+            file_names = []
+            file_map = {}
+            for f in uploaded_files:
+                file_names.append(f.name)
+                file_map[f.name] = f
             sorted_names = st.multiselect(
                 "拖曳調整順序",
-                options=[f.name for f in uploaded_files],
-                default=[f.name for f in uploaded_files]
+                options=file_names,
+                default=file_names
             )
             files_to_process = [file_map[n] for n in sorted_names]
 
@@ -139,93 +305,16 @@ with tab_upload:
             with st.expander("👁️ 預覽內容 (Live Preview)"):
                 preview_content = []
                 for f in files_to_process:
-                    f.seek(0)
-                    content = f.read().decode("utf-8")
+                    # getbuffer() 不移動檔案指標，也不產生額外的 bytes 複本
+                    content = str(f.getbuffer(), "utf-8")
                     if len(files_to_process) > 1:
                         preview_content.append(f"### 📄 檔案: {f.name}\n\n{content}")
                     else:
                         preview_content.append(content)
-                    f.seek(0) # IMPORTANT: Reset cursor for later processing
                 
                 st.markdown("\n\n---\n\n".join(preview_content))
 
-        if st.button("🚀 開始轉換專案", type="primary", use_container_width=True):
-            if not files_to_process:
-                st.error("請至少選擇一個檔案")
-            else:
-                with st.spinner('正在處理文檔與圖表...'):
-                    try:
-                        with tempfile.TemporaryDirectory() as tmpdir:
-                            options = get_conversion_options(tmpdir)
-                            
-                            # Single File or No Merge -> Zip or individual download?
-                            # Logic: If single file, direct download. If multiple and NOT merge, Zip. If merge, direct download.
-                            
-                            # Case 1: Single Output (One file uploaded OR Merge all)
-                            if len(files_to_process) == 1 or merge_output:
-                                if merge_output and len(files_to_process) > 1:
-                                    # Merge Logic
-                                    merged_md_list = []
-                                    page_break = '\n\n```{=openxml}\n<w:p><w:r><w:br w:type="page"/></w:r></w:p>\n```\n\n'
-                                    for file in files_to_process:
-                                        file.seek(0)
-                                        raw = file.read().decode("utf-8")
-                                        merged_md_list.append(process_mermaid_to_local_img(raw, tmpdir))
-                                    final_md = page_break.join(merged_md_list)
-                                    if add_toc: final_md = page_break + final_md # hack for TOC position if needed or handled by pandoc
-                                    
-                                    output_name = "Merged_Document"
-                                else:
-                                    # Single File
-                                    f = files_to_process[0]
-                                    f.seek(0)
-                                    final_md = process_mermaid_to_local_img(f.read().decode("utf-8"), tmpdir)
-                                    output_name = f.name.replace(".md", "")
-
-                                docx_bytes = convert_md_to_docx(final_md, output_name, options, tmpdir)
-                                st.success("🎉 轉換完成！")
-                                st.download_button(
-                                    label=f"📥 下載 {output_name}.docx",
-                                    data=docx_bytes,
-                                    file_name=f"{output_name}.docx",
-                                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                                    type="primary",
-                                    use_container_width=True
-                                )
-                            
-                            # Case 2: Multiple Files, No Merge -> ZIP
-                            else:
-                                zip_buffer = BytesIO()
-                                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-                                    # We need to run conversion for each
-                                    # Reuse logic requires defining args again roughly, or calling convert_md_to_docx loop
-                                    # convert_md_to_docx returns bytes, so we can use it.
-                                    
-                                    progress_text = st.empty()
-                                    bar = st.progress(0)
-                                    
-                                    for i, file in enumerate(files_to_process):
-                                        file.seek(0)
-                                        raw = file.read().decode("utf-8")
-                                        fname = file.name.replace(".md", "")
-                                        docx = convert_md_to_docx(raw, fname, options, tmpdir)
-                                        zf.writestr(f"{fname}.docx", docx)
-                                        bar.progress((i + 1) / len(files_to_process))
-                                    
-                                    progress_text.text("打包完成！")
-                                
-                                st.success("🎉 批量轉換完成！")
-                                st.download_button(
-                                    label="📥 下載轉換結果 (ZIP)",
-                                    data=zip_buffer.getvalue(),
-                                    file_name="converted_docs.zip",
-                                    mime="application/zip",
-                                    type="primary",
-                                    use_container_width=True
-                                )
-
-                    except Exception as e:
-                        st.error(f"發生錯誤: {e}")
+        run_upload_conversion(files_to_process)
 
 # --- TAB 2: Paste ---
 with tab_paste:
@@ -248,10 +337,10 @@ with tab_paste:
         else:
             with st.spinner("轉換中..."):
                 try:
-                    with tempfile.TemporaryDirectory() as tmpdir:
+                    with tempfile.TemporaryDirectory(dir=WORK_DIR_ROOT) as tmpdir:
                         opts = get_conversion_options(tmpdir)
-                        safe_name = re.sub(r'[<>:"/\\|?*]', '_', filename_input.strip())
-                        docx_bytes = convert_md_to_docx(txt_input, safe_name, opts, tmpdir)
+                        safe_name = filename_input.strip().translate(_NAME_TRANS)
+                        docx_bytes = convert_md_to_docx_cached(txt_input, safe_name, opts, tmpdir)
                         
                         st.success("轉換成功！")
                         st.download_button(
@@ -2,78 +2,355 @@ import pypandoc
 import os
 import re
 import base64
+import functools
+import hashlib
+import shlex
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st # Need st for error display currently, in future better to return errors
 
+# 正規表示式：匹配 ```mermaid ... ``` 區塊（模組載入時編譯一次，避免每次呼叫重新編譯）
+_MERMAID_RE = re.compile(r"```mermaid\s+(.*?)```", re.DOTALL | re.IGNORECASE)
+# 快速檢查用：僅比對開頭標記；"```" 為大小寫敏感的字面前綴，可走 re 的前綴快速搜尋
+_MERMAID_FENCE_RE = re.compile(r"```(?i:mermaid)")
+# 同上，供未解碼的 bytes 使用：標記皆為 ASCII，UTF-8 位元組可直接比對
+_MERMAID_FENCE_RE_BYTES = re.compile(rb"```(?i:mermaid)")
+
+# 同時下載 Mermaid 圖片的執行緒數
+MERMAID_MAX_WORKERS = 8
+
+# 模組層級共用的 Session：TLS 連線在多份文件、多次轉換之間保持 keep-alive 重用；
+# mermaid.ink 偶發的 502/503/504 與 429 限流以指數退避自動重試；
+# 不遵循 Retry-After：urllib3 對其等待時間沒有上限，且不受請求 timeout 約束。
+# 連線/讀取逾時不重試，直接交由冷卻機制處理，避免服務中斷時每張圖表等待數倍 timeout
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=MERMAID_MAX_WORKERS,
+    pool_maxsize=MERMAID_MAX_WORKERS,
+    max_retries=Retry(total=3, connect=0, read=0, status=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504],
+                      respect_retry_after_header=False, raise_on_status=False),
+))
+
+# 每位使用者各自的快取根目錄（遵循 XDG_CACHE_HOME），不放在所有人皆可寫入的 /tmp，
+# 避免其他本機使用者預先建立目錄或植入圖片
+CACHE_ROOT = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "md-to-docx")
+# Mermaid 圖片的持久快取目錄：以圖表原始碼的 SHA-256 命名，跨次轉換重用；
+# 可以環境變數 MERMAID_CACHE_DIR 指定其他位置
+MERMAID_CACHE_DIR = os.environ.get("MERMAID_CACHE_DIR") or os.path.join(CACHE_ROOT, "mermaid")
+# 快取目錄中由本程式產生的檔案：<sha256>.png 與下載中途殘留的暫存檔；淘汰時只處理這些檔案
+_CACHE_ENTRY_RE = re.compile(r"[0-9a-f]{64}\.png|tmp\w+\.tmp")
+# mermaid.ink 請求逾時（秒）：(連線, 讀取)；讀取需涵蓋複雜圖表的渲染時間
+MERMAID_TIMEOUT = (5, 30)
+# 快取容量上限，超過時依最近使用時間淘汰最舊的圖片
+MERMAID_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# 自訂範本的快取目錄：以上傳內容的 blake2b 雜湊命名，跨次轉換重用
+TEMPLATE_CACHE_DIR = os.path.join(CACHE_ROOT, "templates")
+_TEMPLATE_ENTRY_RE = re.compile(r"[0-9a-f]{128}\.docx|tmp\w+\.tmp")
+TEMPLATE_CACHE_MAX_BYTES = 100 * 1024 * 1024
+# 快取淘汰的最短間隔（秒）：長時間運行的伺服器也會定期重新檢查容量上限
+CACHE_PRUNE_INTERVAL = 3600
+
+# mermaid.ink 連線失敗後的冷卻秒數：期間內不再送出下載，直接保留原始碼區塊，
+# 避免服務中斷時每張圖表各自等待逾時
+MERMAID_INK_COOLDOWN = 60
+_mermaid_ink_down_until = 0.0
+
+# --- 輔助函式：判斷內容是否含 Mermaid 區塊（str 與 bytes 皆可） ---
+def has_mermaid_blocks(md):
+    if isinstance(md, str):
+        return "```" in md and _MERMAID_FENCE_RE.search(md) is not None
+    # bytes-like（含 memoryview）不支援子序列 in 檢查，直接交由 re 的字面前綴搜尋
+    return _MERMAID_FENCE_RE_BYTES.search(md) is not None
+
+# --- 輔助函式：取得 pandoc 執行檔路徑（每個行程只解析一次） ---
+@functools.lru_cache(maxsize=None)
+def _pandoc_path():
+    # 直接以 subprocess 呼叫此路徑，不經 pypandoc.convert_text 的輸入/輸出格式探測子行程
+    return pypandoc.get_pandoc_path()
+
+# --- 輔助函式：將 Mermaid 原始碼編碼為 mermaid.ink 使用的 base64 鍵值 ---
+@functools.lru_cache(maxsize=256)
+def _mermaid_key(mermaid_code):
+    # 修正：使用 UTF-8 編碼並改用 urlsafe_b64encode 處理中文字元與特殊符號
+    # '=' 只會出現在結尾補位，直接在 bytes 上 rstrip，省去一次全字串 replace 掃描
+    return base64.urlsafe_b64encode(mermaid_code.encode('utf-8')).rstrip(b'=').decode('ascii')
+
+# --- 輔助函式：mermaid.ink 是否不在連線失敗後的冷卻期間 ---
+def _mermaid_ink_available():
+    return time.monotonic() >= _mermaid_ink_down_until
+
+# --- 輔助函式：以原子方式寫入快取檔 ---
+def write_cache_file(path, chunks):
+    """
+    將 chunks（bytes 的可迭代物件）寫入 path 同目錄的暫存檔，完成後以 os.replace 放到定位。
+    並行的讀取端只會看到完整檔案或沒有檔案；寫入中途失敗時移除暫存檔，不留下殘缺的快取。
+    """
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False)
+    try:
+        with f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(f.name, path)
+    except BaseException:
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+        raise
+
+# --- 輔助函式：下載單張 Mermaid 圖片並寫入磁碟（於工作執行緒中執行） ---
+def _download_mermaid_png(session, key, img_path):
+    """
+    下載 mermaid.ink 渲染結果並寫入 img_path，回傳 HTTP 狀態碼。
+    僅在 200 時寫檔；先寫入同目錄暫存檔再 os.replace，避免並行轉換讀到寫一半的快取。
+    mermaid.ink 處於冷卻期間時不送出請求，回傳 None。
+    不呼叫任何 Streamlit API。
+    """
+    global _mermaid_ink_down_until
+    if not _mermaid_ink_available():
+        return None
+    # 使用 mermaid.ink 的圖片渲染路徑；連線逾時短、讀取逾時長，以應對複雜圖表的渲染時間
+    # stream=True：以 64 KiB 區塊寫檔，並行下載時不需在記憶體中保留整張圖片
+    try:
+        resp = session.get(f"https://mermaid.ink/img/{key}", timeout=MERMAID_TIMEOUT, stream=True)
+    except requests.ConnectionError:
+        # 無法建立連線（含連線逾時）才視為服務中斷，佇列中其餘圖表與之後的轉換直接略過；
+        # 讀取逾時或內容傳輸中斷可能只是單張複雜圖表渲染過久，只讓該圖表失敗
+        _mermaid_ink_down_until = time.monotonic() + MERMAID_INK_COOLDOWN
+        raise
+    with resp:
+        if resp.status_code == 200:
+            write_cache_file(img_path, resp.iter_content(chunk_size=64 * 1024))
+        return resp.status_code
+
+# --- 輔助函式：以本機 mermaid-cli 一次渲染多張圖表 ---
+def _render_mermaid_with_mmdc(pending, tmpdir):
+    """
+    若系統已安裝 mermaid-cli (mmdc)，將所有待渲染圖表寫入同一份 Markdown，
+    只啟動一次 Chromium 完成渲染，並將結果以 write_cache_file 寫入各自的快取路徑
+    （工作目錄與快取可能位於不同檔案系統，shutil.move 會退化為非原子的複製）。
+    
+    Args:
+        pending: {key: (mermaid_code, img_path), ...}
+        tmpdir: 臨時目錄路徑
+        
+    Returns:
+        set: 成功渲染的 key；未安裝 mmdc 或執行失敗時為空集合
+    """
+    mmdc = shutil.which("mmdc")
+    if mmdc is None or not pending:
+        return set()
+    
+    batch_dir = tempfile.mkdtemp(dir=tmpdir)
+    in_path = os.path.join(batch_dir, "diagrams.md")
+    out_path = os.path.join(batch_dir, "rendered.md")
+    keys = list(pending)
+    with open(in_path, "w", encoding="utf-8") as f:
+        for key in keys:
+            f.write(f"```mermaid\n{pending[key][0]}\n```\n\n")
+    
+    try:
+        # Markdown 輸入時 mmdc 依序輸出 rendered-1.png、rendered-2.png ...
+        subprocess.run([mmdc, "-i", in_path, "-o", out_path, "-e", "png"], capture_output=True, timeout=120, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return set()
+    
+    rendered = set()
+    for i, key in enumerate(keys, start=1):
+        artefact = os.path.join(batch_dir, f"rendered-{i}.png")
+        if os.path.exists(artefact):
+            with open(artefact, "rb") as src:
+                write_cache_file(pending[key][1], iter(lambda: src.read(64 * 1024), b""))
+            rendered.add(key)
+    return rendered
+
+# --- 快取維護：依 LRU 將快取目錄控制在容量上限內 ---
+def _prune_cache_dir(cache_dir, max_bytes, entry_re):
+    """
+    依修改時間（命中時會更新，等同最近使用時間）由舊到新刪除快取檔案，
+    直到總容量不超過 max_bytes。只處理檔名符合 entry_re 的檔案，
+    快取目錄指向共用目錄時不會刪除其他檔案。
+    
+    Returns:
+        int: 刪除的檔案數
+    """
+    try:
+        entries = [e for e in os.scandir(cache_dir)
+                   if entry_re.fullmatch(e.name) and e.is_file(follow_symlinks=False)]
+    except OSError:
+        return 0
+    
+    stats = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in entries]
+    total = sum(size for _, size, _ in stats)
+    removed = 0
+    for _, size, path in sorted(stats):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+# --- 快取維護：由每次腳本執行呼叫，實際掃描至多每 CACHE_PRUNE_INTERVAL 秒一次 ---
+@st.cache_resource(show_spinner=False, ttl=CACHE_PRUNE_INTERVAL)
+def prune_mermaid_cache(max_bytes: int = MERMAID_CACHE_MAX_BYTES) -> int:
+    return _prune_cache_dir(MERMAID_CACHE_DIR, max_bytes, _CACHE_ENTRY_RE)
+
+@st.cache_resource(show_spinner=False, ttl=CACHE_PRUNE_INTERVAL)
+def prune_template_cache(max_bytes: int = TEMPLATE_CACHE_MAX_BYTES) -> int:
+    return _prune_cache_dir(TEMPLATE_CACHE_DIR, max_bytes, _TEMPLATE_ENTRY_RE)
+
+# --- 輔助函式：建立僅限目前使用者使用的快取目錄 ---
+def ensure_private_dir(path):
+    """
+    以 0700 權限建立 path（已存在則沿用），並確認它是目前使用者擁有的實體目錄、
+    且其他使用者無法寫入，否則拋出 OSError，由呼叫端退回本次轉換的暫存目錄。
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st_info = os.lstat(path)
+    if not stat.S_ISDIR(st_info.st_mode):
+        raise OSError(f"快取路徑不是目錄: {path}")
+    if hasattr(os, "getuid") and (st_info.st_uid != os.getuid() or st_info.st_mode & 0o022):
+        raise OSError(f"快取目錄不屬於目前使用者或可被他人寫入: {path}")
+    return path
+
+# --- 輔助函式：取得可寫入的 Mermaid 圖片快取目錄 ---
+def _mermaid_cache_dir(tmpdir):
+    try:
+        return ensure_private_dir(MERMAID_CACHE_DIR)
+    except OSError:
+        # 無法建立持久快取時退回本次轉換的暫存目錄
+        return tmpdir
+
 # --- 核心功能：處理 Mermaid 並轉換為本地圖片 ---
-def process_mermaid_to_local_img(md_text, tmpdir):
+def process_mermaid_to_local_img(md_text, tmpdir, mermaid_cache=None):
     """
     解析 Markdown 中的 Mermaid 區塊，將其轉換為 URL 安全的編碼，
     並下載為實體 PNG 檔案供 Pandoc 嵌入。
+    
+    若已安裝 mermaid-cli (mmdc)，先以單次 mmdc 執行渲染全部圖表；
+    其餘圖表以共用連線池的 Session 並行下載，再一次性替換回文件中。
+    相同內容的圖表以 base64 編碼為鍵只下載一次；傳入同一個 mermaid_cache
+    dict 可讓整批檔案共用已下載的圖片。圖片以原始碼 SHA-256 命名存於
+    MERMAID_CACHE_DIR，之後的轉換遇到相同圖表時直接使用磁碟上的檔案。
     """
-    # 統一處理換行符號，避免匹配失敗
+    # 快速路徑：不含 Mermaid 區塊時直接返回，省去換行正規化、完整正規表示式與連線池建立成本
+    if not has_mermaid_blocks(md_text):
+        return md_text
+    
+    # 統一處理換行符號，避免匹配失敗（無 CRLF 時 str.replace 直接回傳原物件，不會複製）
     md_text = md_text.replace('\r\n', '\n')
     
-    # 正規表示式：匹配 ```mermaid ... ``` 區塊
-    pattern = re.compile(r"```mermaid\s+(.*?)```", re.DOTALL | re.IGNORECASE)
+    matches = list(_MERMAID_RE.finditer(md_text))
+    if not matches:
+        return md_text
+    codes = [m.group(1).strip() for m in matches]
+    keys = [_mermaid_key(code) if code else None for code in codes]
+    
+    if mermaid_cache is None:
+        mermaid_cache = {}
+    
+    # 先查快取，找出真正需要下載的圖表
+    cache_dir = _mermaid_cache_dir(tmpdir)
+    to_fetch = {}
+    for code, key in zip(codes, keys):
+        if not code or key in mermaid_cache or key in to_fetch:
+            continue
+        # 內容定址：相同原始碼對應相同檔名，已存在即不必下載
+        digest = hashlib.sha256(code.encode('utf-8')).hexdigest()
+        img_path = os.path.join(cache_dir, f"{digest}.png")
+        if os.path.exists(img_path):
+            # 更新修改時間，讓 LRU 淘汰以最近使用為準
+            os.utime(img_path)
+            mermaid_cache[key] = img_path
+        else:
+            to_fetch[key] = (code, img_path)
     
-    def download_img(match):
-        mermaid_code = match.group(1).strip()
+    # 優先以本機 mmdc 批次渲染；未安裝或渲染失敗的圖表再向 mermaid.ink 下載
+    for key in _render_mermaid_with_mmdc(to_fetch, tmpdir):
+        mermaid_cache[key] = to_fetch.pop(key)[1]
+    
+    # 並行下載：執行緒內完成 HTTP 請求與寫檔，Streamlit 訊息留在主執行緒輸出
+    futures = {}
+    if to_fetch and _mermaid_ink_available():
+        with ThreadPoolExecutor(max_workers=MERMAID_MAX_WORKERS) as executor:
+            for key, (_, img_path) in to_fetch.items():
+                futures[key] = (img_path, executor.submit(_download_mermaid_png, _SESSION, key, img_path))
+    
+    def render_block(mermaid_code, key):
         if not mermaid_code:
             return ""
             
-        try:
-            # 修正：使用 UTF-8 編碼並改用 urlsafe_b64encode 處理中文字元與特殊符號
-            code_bytes = mermaid_code.encode('utf-8')
-            base64_code = base64.urlsafe_b64encode(code_bytes).decode('utf-8').replace('=', '')
-            
-            # 使用 mermaid.ink 的圖片渲染路徑
-            url = f"https://mermaid.ink/img/{base64_code}"
+        if key in mermaid_cache:
+            return f"\n\n![Mermaid Chart]({mermaid_cache[key]})\n\n"
             
-            # 建立本地臨時圖檔路徑
-            img_filename = f"chart_{os.urandom(4).hex()}.png"
-            img_path = os.path.join(tmpdir, img_filename)
-            
-            # 執行下載，增加 timeout 以應對複雜圖表的渲染時間
-            resp = requests.get(url, timeout=30)
+        try:
+            img_path, future = futures.get(key, (None, None))
+            status_code = future.result() if future else None
             
-            if resp.status_code == 200:
-                with open(img_path, "wb") as f:
-                    f.write(resp.content)
+            if status_code is None:
+                # mermaid.ink 冷卻中未下載：保留原始碼區塊，訊息於最後統一顯示一次
+                skipped.append(key)
+                return f"\n\n```mermaid\n{mermaid_code}\n```\n\n"
+            elif status_code == 200:
+                mermaid_cache[key] = img_path
                 # 重要：返回本地實體路徑，前後加上換行確保 Word 格式正確
                 return f"\n\n![Mermaid Chart]({img_path})\n\n"
             else:
-                st.error(f"Mermaid 渲染失敗 (HTTP {resp.status_code})。請檢查語法或網路連結。")
-                return f"\n\n> [!CAUTION] Mermaid 渲染失敗 (HTTP {resp.status_code})\n\n```mermaid\n{mermaid_code}\n```\n\n"
+                st.error(f"Mermaid 渲染失敗 (HTTP {status_code})。請檢查語法或網路連結。")
+                return f"\n\n> [!CAUTION] Mermaid 渲染失敗 (HTTP {status_code})\n\n```mermaid\n{mermaid_code}\n```\n\n"
                 
         except Exception as e:
             st.warning(f"圖表下載異常: {e}")
             return f"\n\n```mermaid\n{mermaid_code}\n```\n\n"
 
-    return pattern.sub(download_img, md_text)
+    # 以 finditer 的位置直接拼接結果，不經 re.sub 回呼，也不再重新掃描全文
+    skipped = []
+    parts = []
+    last = 0
+    for m, code, key in zip(matches, codes, keys):
+        parts.append(md_text[last:m.start()])
+        parts.append(render_block(code, key))
+        last = m.end()
+    parts.append(md_text[last:])
+    if skipped:
+        st.warning(f"mermaid.ink 暫時無法連線，已略過 {len(skipped)} 張圖表並保留原始碼。")
+    return "".join(parts)
 
-# --- 核心轉換函式：將 Markdown 轉換為 DOCX ---
-def convert_md_to_docx(md_content: str, output_filename: str, options: dict, tmpdir: str) -> bytes:
+# --- 預熱：每個行程只執行一次，讓 pandoc 執行檔提前載入 ---
+@st.cache_resource(show_spinner=False)
+def warm_up_pandoc() -> str:
     """
-    核心轉換函式：將 Markdown 內容轉換為 DOCX 格式。
+    解析 pandoc 路徑並執行一次 `pandoc --version`，使執行檔預先載入系統快取，
+    避免第一次轉換時才承擔冷啟動成本。
     
-    Args:
-        md_content: Markdown 文字內容
-        output_filename: 輸出檔名（不含副檔名）
-        options: 轉換選項 dict，包含:
-            - add_toc: bool
-            - math_support: bool  
-            - ref_path: str (範本路徑，可為 None)
-            - meta_title, meta_author, meta_date: str
-        tmpdir: 臨時目錄路徑
-        
     Returns:
-        bytes: DOCX 檔案的二進位內容
+        str: pandoc 版本資訊第一行；無法執行時回傳空字串
     """
-    # 處理 Mermaid 流程圖
-    processed_md = process_mermaid_to_local_img(md_content, tmpdir)
+    try:
+        result = subprocess.run([_pandoc_path(), "--version"], capture_output=True, timeout=30)
+        return result.stdout.decode("utf-8", errors="replace").split("\n", 1)[0]
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+# --- 輔助函式：依轉換選項組出 Pandoc 參數 ---
+def build_pandoc_args(options: dict) -> tuple:
+    """
+    依轉換選項建立 Pandoc 命令列參數（不含輸入/輸出檔）。
     
-    # 設定 Pandoc 參數
+    回傳不可變的 tuple，於批次迴圈外建立一次後供每個檔案共用。
+    """
     args = ["--standalone"]
     if options.get("add_toc"): 
         args.append("--toc")
@@ -90,13 +367,194 @@ def convert_md_to_docx(md_content: str, output_filename: str, options: dict, tmp
         args.append(f"--metadata=author:{options['meta_author']}")
     if options.get("meta_date"): 
         args.append(f"--metadata=date:{options['meta_date']}")
+    return tuple(args)
+
+# --- 核心轉換函式：將 Markdown 轉換為 DOCX ---
+def convert_md_to_docx(md_content, output_filename: str, options: dict, tmpdir: str, skip_mermaid: bool = False) -> bytes:
+    """
+    核心轉換函式：將 Markdown 內容轉換為 DOCX 格式。
+    
+    Args:
+        md_content: Markdown 內容（str，或 UTF-8 編碼的 bytes）
+        output_filename: 輸出檔名（不含副檔名；輸出改走 stdout 後僅保留作為呼叫介面）
+        options: 轉換選項 dict，包含:
+            - add_toc: bool
+            - math_support: bool  
+            - ref_path: str (範本路徑，可為 None)
+            - meta_title, meta_author, meta_date: str
+        tmpdir: 臨時目錄路徑（skip_mermaid=True 時不使用，可為 None）
+        skip_mermaid: 內容已由呼叫端處理過 Mermaid 時設為 True，略過重複掃描
+        
+    Returns:
+        bytes: DOCX 檔案的二進位內容
+    """
+    # bytes 輸入且不含 Mermaid 時原樣送入 Pandoc，省去解碼再編碼的往返
+    if not isinstance(md_content, str):
+        if skip_mermaid or not has_mermaid_blocks(md_content):
+            return _run_pandoc_to_bytes(options, input_bytes=bytes(md_content))
+        md_content = str(md_content, "utf-8")
+    
+    # 處理 Mermaid 流程圖
+    processed_md = md_content if skip_mermaid else process_mermaid_to_local_img(md_content, tmpdir)
+    
+    # 執行轉換：Markdown 經 stdin 傳入，docx 由 stdout (-o -) 直接取回，不經暫存檔
+    return _run_pandoc_to_bytes(options, input_bytes=processed_md.encode("utf-8"))
+
+# --- 檔案轉換函式：直接由磁碟上的 Markdown 檔轉換為 DOCX ---
+def convert_md_file_to_docx(md_path: str, options: dict) -> bytes:
+    """
+    將已寫入磁碟的 Markdown 檔（Mermaid 須已處理）轉換為 DOCX。
+    適用於合併輸出等大型內容：由 pandoc 自行讀檔，不需在記憶體中組出完整字串。
+    
+    Args:
+        md_path: Markdown 檔案路徑
+        options: 轉換選項 dict（同 convert_md_to_docx）
+        
+    Returns:
+        bytes: DOCX 檔案的二進位內容
+    """
+    return _run_pandoc_to_bytes(options, input_path=md_path)
+
+# --- 輔助函式：執行 pandoc 並由 stdout 取回 docx ---
+def _run_pandoc_to_bytes(options, input_bytes=None, input_path=None):
+    cmd = [_pandoc_path(), "--from=markdown", "--to=docx", *build_pandoc_args(options), "-o", "-"]
+    if input_path:
+        cmd.append(input_path)
+    result = subprocess.run(cmd, input=input_bytes, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Pandoc 轉換失敗: {result.stderr.decode('utf-8', errors='replace')}")
+    return result.stdout
+
+# --- 輔助函式：以串流方式將上傳檔寫入磁碟 ---
+def _stream_markdown_to_file(source, path, chunk_size=64 * 1024):
+    """
+    分塊將二進位檔案物件原樣寫入 path，記憶體中最多只保留一個區塊。
+    不經解碼：標記偵測直接比對位元組，UTF-8 的驗證交由 Pandoc 讀檔時處理。
+    
+    Returns:
+        bool: 內容是否含有 ```mermaid 區塊（需要後續處理）
+    """
+    fence_len = len(b"```mermaid")
+    has_mermaid = False
+    tail = b""
+    source.seek(0)
+    with open(path, "wb") as f:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            if not has_mermaid:
+                # 保留前一區塊尾端，避免標記被切在區塊邊界
+                window = tail + chunk
+                has_mermaid = _MERMAID_FENCE_RE_BYTES.search(window) is not None
+                tail = window[-fence_len:]
+            f.write(chunk)
+    return has_mermaid
+
+# --- 批次轉換：以少量子行程完成多檔轉換 ---
+# 每個 shell 子行程最多處理的檔案數：進度條以組為單位更新，組別小才能逐步前進
+BATCH_CHUNK_MAX_FILES = 4
+
+# shell 腳本中指令失敗時寫入 stderr 的標記，後接該指令在本組中的序號
+_FAILED_MARKER = "__MDAPP_FAILED__:"
+
+def _run_pandoc_commands(commands: list, names: list) -> None:
+    """
+    在單一 shell 子行程中依序執行多條 pandoc 指令，任一失敗即中止。
+    無 POSIX shell（如 Windows）時改為逐條直接執行。
+    names 與 commands 一一對應，用於在錯誤訊息中標明失敗的檔案。
+    """
+    if shutil.which("sh") is None:
+        for cmd, name in zip(commands, names):
+            result = subprocess.run(cmd, capture_output=True)
+            if result.returncode != 0:
+                raise RuntimeError(f"Pandoc 批次轉換失敗（{name}）: {result.stderr.decode('utf-8', errors='replace')}")
+        return
     
-    # 執行轉換
-    temp_docx_path = os.path.join(tmpdir, f"{output_filename}.docx")
-    pypandoc.convert_text(
-        processed_md, 'docx', format='md', extra_args=args, outputfile=temp_docx_path
+    # 腳本經 stdin 傳給 sh -s，不受單一命令列參數 128 KiB 的長度上限限制；
+    # 各指令的 stdin 改接 /dev/null，避免子行程讀走尚未執行的腳本內容
+    script = "\n".join(
+        f'{shlex.join(cmd)} </dev/null || {{ echo "{_FAILED_MARKER}{i}" >&2; exit 1; }}'
+        for i, cmd in enumerate(commands)
     )
+    result = subprocess.run(["sh", "-s"], input=script.encode("utf-8"), capture_output=True)
+    if result.returncode != 0:
+        stderr = result.stderr.decode('utf-8', errors='replace')
+        # 由標記序號對應回檔名，並自訊息中移除標記
+        detail, marker, index = stderr.rstrip().rpartition(_FAILED_MARKER)
+        if marker and index.isdigit():
+            raise RuntimeError(f"Pandoc 批次轉換失敗（{names[int(index)]}）: {detail.strip()}")
+        raise RuntimeError(f"Pandoc 批次轉換失敗: {stderr}")
+
+def batch_convert(files: list, options: dict, tmpdir: str, max_workers: int = None, progress_callback=None) -> list:
+    """
+    批次將多個 Markdown 轉換為 DOCX。
+    
+    Pandoc 無法在一次執行中輸出多份 docx，因此改為將所有輸入寫入暫存目錄，
+    再將指令平均分給數個 shell 子行程並行執行，省去每個檔案各自經過 pypandoc
+    的啟動與 Python↔子行程往返成本。實際運算在 pandoc 子行程中，
+    因此以執行緒驅動即可，不需 ProcessPoolExecutor。
+    每一組輸入準備完成即開始轉換，與後續檔案的 Mermaid 下載重疊進行。
+    
+    Args:
+        files: [(output_filename, md_content), ...]；md_content 可為字串，
+               或二進位檔案物件（如 UploadedFile，將分塊原樣複製到磁碟，不經解碼）
+        options: 轉換選項 dict（同 convert_md_to_docx）
+        tmpdir: 臨時目錄路徑
+        max_workers: 並行子行程數上限，預設為 CPU 核心數
+        progress_callback: 選用，每組（至多 BATCH_CHUNK_MAX_FILES 個檔案）完成時
+                           以 (已完成檔數, 總檔數) 呼叫（於呼叫端執行緒）
+        
+    Returns:
+        list: [(output_filename, docx_path), ...]，順序與輸入相同。
+              回傳路徑而非 bytes，呼叫端可直接以 ZipFile.write 串流寫入，免去整檔讀入記憶體。
+    """
+    if not files:
+        return []
+    
+    # 基本指令於迴圈外建立一次，每個檔案只附加自己的輸入/輸出路徑
+    pandoc_cmd = (_pandoc_path(), "--from=markdown", "--to=docx", *build_pandoc_args(options))
+    
+    # 依核心數切成連續的數組，每組由一個 shell 子行程執行；
+    # 每組不超過 BATCH_CHUNK_MAX_FILES 個檔案，單核主機上進度條也能逐步更新
+    workers = min(max_workers or os.cpu_count() or 1, len(files))
+    chunk_size = min(-(-len(files) // workers), BATCH_CHUNK_MAX_FILES)
+    
+    outputs = []
+    mermaid_cache = {}
+    futures = {}
+    chunk = []
+    chunk_names = []
+    # 管線化：某一組輸入準備好（含 Mermaid 下載）即送出轉換，
+    # 讓前面檔案的 pandoc 與後面檔案的圖表下載同時進行
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, (name, md_content) in enumerate(files):
+            in_path = os.path.join(tmpdir, f"in_{i}.md")
+            out_path = os.path.join(tmpdir, f"out_{i}.docx")
+            if not isinstance(md_content, str):
+                # 串流寫入；僅在含 Mermaid 區塊時才讀回完整內容處理
+                if not _stream_markdown_to_file(md_content, in_path):
+                    md_content = None
+                else:
+                    with open(in_path, "r", encoding="utf-8", newline="") as f:
+                        md_content = f.read()
+            if md_content is not None:
+                with open(in_path, "w", encoding="utf-8") as f:
+                    f.write(process_mermaid_to_local_img(md_content, tmpdir, mermaid_cache))
+            chunk.append([*pandoc_cmd, "-o", out_path, in_path])
+            chunk_names.append(name)
+            outputs.append((name, out_path))
+            
+            if len(chunk) == chunk_size or i == len(files) - 1:
+                futures[executor.submit(_run_pandoc_commands, chunk, chunk_names)] = len(chunk)
+                chunk = []
+                chunk_names = []
+        
+        done = 0
+        for future in as_completed(futures):
+            future.result()
+            done += futures[future]
+            if progress_callback:
+                progress_callback(done, len(files))
     
-    # 讀取並返回二進位內容
-    with open(temp_docx_path, "rb") as f:
-        return f.read()
+    return outputs